@@ -9,13 +9,32 @@ __author__ = "Stephan Sokolow (deitarion/SSokolow)"
 __license__ = "MIT"
 
 import datetime, errno, os, platform, sqlite3, subprocess, sys, time
-import random, socket, webbrowser
+import argparse, collections, copy, io, itertools, json, multiprocessing
+import random
+import re, socket, stat, threading, webbrowser
+
+from email.utils import mktime_tz, parsedate_tz
 
 try:
     import http.server as http_server
 except ImportError:  # pragma: no cover
     import BaseHTTPServer as http_server
 
+try:
+    import urllib.request as urllib_request
+except ImportError:  # pragma: no cover
+    import urllib2 as urllib_request
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # pragma: no cover
+    from collections import Mapping  # pylint: disable=no-name-in-module
+
+try:
+    import socketserver
+except ImportError:  # pragma: no cover
+    import SocketServer as socketserver
+
 OS_ERROR = OSError  # pylint: disable=invalid-name
 CACHE_ROOT = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
 if os.name == 'nt':  # pragma: no cover
@@ -36,6 +55,10 @@ else:
 # Ctrl+S, Enter, and clicking "next page", assuming blocking HTTP requests.
 DEFAULT_BASE_DELAY = 3  # seconds
 
+# SQLite connections inherited across a fork. Kept referenced so that garbage
+# collection never closes them out from under the parent process.
+_ABANDONED_CONNECTIONS = []
+
 def _timestamp(dt_obj):
     """Convert a naive datetime into a POSIX timestamp.
 
@@ -108,7 +131,147 @@ class UAProbingRequestHandler(http_server.BaseHTTPRequestHandler):
         """Silence the usual logging messages"""
         pass
 
-class UserHeaderGetter(object):
+class HeaderPolicy(object):
+    """A set of header names compiled for fast, case-insensitive matching.
+
+    ``names`` must match exactly, ``prefixes`` match any header name which
+    begins with them, and ``patterns`` are regular expressions which must
+    match the entire name. All three are compiled into a single regex once
+    and the decision for each name is cached, up to `cache_size` entries.
+    """
+    cache_size = 1024
+
+    def __init__(self, names=(), prefixes=(), patterns=()):
+        self.names = frozenset(names)
+        self.prefixes = tuple(prefixes)
+        self.patterns = tuple(patterns)
+
+        alternatives = ([re.escape(x) for x in sorted(self.names)] +
+                        [re.escape(x) + '.*' for x in self.prefixes] +
+                        ['(?:{})'.format(x) for x in self.patterns])
+        self._matcher = re.compile('(?:{})\\Z'.format(
+            '|'.join(alternatives) or '(?!)'), re.IGNORECASE)
+        self._decisions = {}
+
+    def __contains__(self, name):
+        try:
+            return self._decisions[name]
+        except KeyError:
+            if len(self._decisions) >= self.cache_size:
+                self._decisions.clear()  # Same strategy as the re module
+            result = self._decisions[name] = bool(self._matcher.match(name))
+            return result
+
+    def __repr__(self):
+        return '{}({!r}, prefixes={!r}, patterns={!r})'.format(
+            type(self).__name__, sorted(self.names), self.prefixes,
+            self.patterns)
+
+    def extend(self, names=(), prefixes=(), patterns=()):
+        """Return a new policy matching everything this one does and more"""
+        return type(self)(self.names.union(names),
+                          self.prefixes + tuple(prefixes),
+                          self.patterns + tuple(patterns))
+
+class _PerClass(object):  # pylint: disable=too-few-public-methods
+    """Descriptor which computes ``factory(cls)`` on first use, once per
+    class, and caches the result.
+
+    (So subclasses which customize the attributes ``factory`` reads get a
+     matching value, while subclasses or instances which assign the
+     attribute directly override it.)
+    """
+    def __init__(self, factory):
+        self.factory = factory
+        self._values = {}
+
+    def __get__(self, obj, cls):
+        if cls not in self._values:
+            self._values[cls] = self.factory(cls)
+        return self._values[cls]
+
+class HeaderOverlay(Mapping):
+    """Immutable view of a dict of headers with some values overridden.
+
+    Lookups check ``overrides`` first and fall through to ``base``, which is
+    shared rather than copied. An override of None hides a base header.
+    """
+    def __init__(self, base, overrides=None):
+        self._base = base
+        self._overrides = overrides or {}
+
+    def __getitem__(self, key):
+        if key in self._overrides:
+            value = self._overrides[key]
+            if value is None:
+                raise KeyError(key)
+            return value
+        return self._base[key]
+
+    def __iter__(self):
+        for key in self._base:
+            if key not in self._overrides:
+                yield key
+        for key, value in self._overrides.items():
+            if value is not None:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, dict(self))
+
+class RecordError(ValueError):
+    """Raised when an input record for `filter_stream` can't be parsed"""
+
+class HarvestTimeoutError(Exception):
+    """Raised when the browser didn't request the probe page in time and
+    there were no cached or default headers to fall back on."""
+
+class _SQLiteStore(object):
+    """Base for classes which keep their data in the SQLite file at
+    ``cache_path``, set up with ``cache_schema`` on connecting."""
+    cache_path = None
+    cache_schema = ""
+    _cache_conn, _cache_pid = None, None
+
+    def _create_store(self):
+        """Create the directory for ``cache_path`` and connect to it now so
+        that permission errors surface in the constructor"""
+        try:
+            os.makedirs(os.path.dirname(self.cache_path))
+        except OS_ERROR as err:
+            if not err.errno == errno.EEXIST:
+                raise
+        self.cache_conn  # pylint: disable=pointless-statement
+
+    @property
+    def cache_conn(self):
+        """The SQLite connection to the cache, reopened after a fork.
+
+        SQLite connections must not be used across a ``fork()``, so, when a
+        child process first touches the cache, a fresh one is opened. The
+        inherited one is abandoned rather than closed, because closing also
+        counts as use: it acts on state shared with the parent, such as
+        rolling back an open transaction or, in WAL mode, checkpointing and
+        deleting a ``-wal`` file the parent is still using.
+        """
+        if self.cache_path is None:
+            raise sqlite3.ProgrammingError("This instance has no cache")
+        if self._cache_pid != os.getpid():
+            if self._cache_conn is not None:
+                _ABANDONED_CONNECTIONS.append(self._cache_conn)
+            self._cache_conn = sqlite3.connect(self.cache_path)
+            self._cache_conn.executescript(self.cache_schema)
+            self._cache_pid = os.getpid()
+            self._connected()
+        return self._cache_conn
+
+    def _connected(self):
+        """Called whenever `cache_conn` opens a new connection"""
+
+class UserHeaderGetter(_SQLiteStore):
     """Wrapper to represent a persistent cache for headers and the code to
     retrieve new ones when stale.
 
@@ -123,6 +286,18 @@ class UserHeaderGetter(object):
     # How long retrieved headers should be cached to avoid bothering the user
     # by popping open a new browser tab
     cache_timeout = datetime.timedelta(days=7)
+
+    # How long to wait (in seconds) for the browser to request the probe page
+    # before falling back to stale or `default_headers`. (None waits forever)
+    harvest_timeout = None
+
+    # How long to serve the fallback after a harvest times out before
+    # opening another browser tab to try again
+    harvest_retry_interval = datetime.timedelta(minutes=5)
+
+    # Headers to fall back on if harvesting times out with nothing cached
+    default_headers = None
+
     cache_schema = """
         CREATE TABLE IF NOT EXISTS user_headers (
             py_version INTEGER NOT NULL,
@@ -134,6 +309,10 @@ class UserHeaderGetter(object):
             ON user_headers (py_version, key);
         CREATE INDEX IF NOT EXISTS user_headers_expires
             ON user_headers (expires);
+        CREATE TABLE IF NOT EXISTS cache_meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
     """
 
     # Headers which should either have a null or desired effect on returned
@@ -149,6 +328,11 @@ class UserHeaderGetter(object):
                              # can consistently agree on it and AT&T's site
                              # gives it all-lowercase, including the X- prefix
         'X-Wap-Profile',
+        # Low-entropy User-Agent Client Hints, sent by default without the
+        # server having to request them via an Accept-CH response header
+        'Sec-CH-UA',
+        'Sec-CH-UA-Mobile',
+        'Sec-CH-UA-Platform',
     ])
 
     # Headers which should never be retrieved for safety reasons
@@ -186,6 +370,10 @@ class UserHeaderGetter(object):
         'Origin',
         'Range',
         'Referer',
+        'Sec-Fetch-Dest',
+        'Sec-Fetch-Mode',
+        'Sec-Fetch-Site',
+        'Sec-Fetch-User',
         'TE',
         "Transfer-Encoding",
         'Upgrade',
@@ -220,18 +408,57 @@ class UserHeaderGetter(object):
         'X-Forwarded-For',   # TODO: Do any client-side proxies set this?
     ])
 
+    # What `get_safe` and `get_all` actually match against. By default, these
+    # are compiled from `safe_headers` and `unsafe_headers` (as customized by
+    # subclasses) but they can be replaced to match whole families of
+    # headers in one pass.
+    safe_policy = _PerClass(lambda cls: HeaderPolicy(cls.safe_headers))
+    unsafe_policy = _PerClass(lambda cls: HeaderPolicy(
+        cls.unsafe_headers, prefixes=['Sec-Fetch-']))
+
+    # Lowercase-to-canonical mapping used by `normalize_header_names`
+    _known_lowercase = _PerClass(
+        lambda cls: {x.lower(): x for x in cls.known_headers})
+
     def __init__(self, path=None):
         path = path or CACHE_DIR
-        self.cache_path = os.path.join(path, 'cache.sqlite3')
+        self._init_state(os.path.join(path, 'cache.sqlite3'))
+        self._create_store()
 
-        # Create the store if not already initialized
-        try:
-            os.makedirs(path)
-        except OS_ERROR as err:
-            if not err.errno == errno.EEXIST:
-                raise
-        self.cache_conn = sqlite3.connect(self.cache_path)
-        self.cache_conn.executescript(self.cache_schema)
+    @classmethod
+    def filter_only(cls):
+        """Return an instance for filtering headers which has no cache.
+
+        (For `filter_stream` and passing headers to `get_all`/`get_safe`.
+         No directory is created and no SQLite connection is opened, so
+         anything which needs the cache will raise an error.)
+        """
+        getter = cls.__new__(cls)
+        getter._init_state(None)  # pylint: disable=protected-access
+        return getter
+
+    def _init_state(self, cache_path):
+        """Initialize instance attributes (Shared with `filter_only`)"""
+        self.cache_path = cache_path
+        self._cache_conn, self._cache_pid = None, None
+        self._data_version, self._generation = None, 0
+        self._preloaded = None
+        self._harvest_failed_at = None
+        self._overlays, self._overlay_views = {}, {}
+        self._overlay_base, self._overlay_source = None, None
+
+    def __getstate__(self):
+        """Pickle everything but the SQLite connection.
+
+        (The unpickled copy will open its own connection if it needs one.
+         This is what `filter_stream` ships to its worker processes.)
+        """
+        state = self.__dict__.copy()
+        state['_cache_conn'], state['_cache_pid'] = None, None
+        return state
+
+    def _connected(self):
+        self._data_version = None  # Counters are per-connection
 
     def clear_expired(self):
         """Purge expired cache entries"""
@@ -246,10 +473,20 @@ class UserHeaderGetter(object):
         """
         result = {}
         for key, value in self.normalize_header_names(headers).items():
-            if key not in self.unsafe_headers:
+            if key not in self.unsafe_policy:
                 result[key] = value
         return result
 
+    def _classify_headers(self, headers, safe_only=False):
+        """Filter one dict of headers without ever touching cache or browser
+
+        (Shared between the in-process and worker-process paths through
+         `filter_stream`)
+        """
+        if safe_only:
+            return self.get_safe(headers) if headers else {}
+        return self._filter_headers(headers)
+
     def _get_cache(self):
         """Retrieve cached headers.
 
@@ -275,38 +512,228 @@ class UserHeaderGetter(object):
             (To work around the fact that we don't control the lifetime of
              instances or the calling API but need to pass data back out.)
             """
+            def setup(self):
+                """Time out stalled reads when the harvest's time is up"""
+                if self.deadline is not None:
+                    self.timeout = max(self.deadline - time.time(), 0.01)
+                UAProbingRequestHandler.setup(self)
+
+        deadline = None
+        if self.harvest_timeout is not None:
+            deadline = time.time() + self.harvest_timeout
         PreparedRequestHandler.harvested_headers = []
+        PreparedRequestHandler.deadline = deadline
 
         httpd, port = self._init_httpd_on_random(PreparedRequestHandler)
         request_url = 'http://localhost:{:d}'.format(port)
-
-        # FIXME: Fire off the subprocess/webbrowser call in another thread to
-        #        minimize the chance of a race condition. (And block until the
-        #        server is ready to accept requests in order to ENSURE it.)
-        webbrowser_open(request_url)
-        httpd.handle_request()
-        httpd.server_close()  # Supposedly proper shutdown
-        httpd.socket.close()  # Required to silence Py3 unclosed socket warning
+        try:
+            # FIXME: Fire off the subprocess/webbrowser call in another thread
+            #        to minimize the chance of a race condition. (And block
+            #        until the server is ready to accept requests in order to
+            #        ENSURE it.)
+            webbrowser_open(request_url)
+            while not PreparedRequestHandler.harvested_headers:
+                if deadline is not None:
+                    httpd.timeout = deadline - time.time()
+                    if httpd.timeout <= 0:
+                        raise HarvestTimeoutError("No request from the "
+                            "browser within {} seconds".format(
+                                self.harvest_timeout))
+                httpd.handle_request()
+        finally:
+            httpd.server_close()  # Supposedly proper shutdown
+            httpd.socket.close()  # Required to silence Py3 unclosed socket
         return PreparedRequestHandler.harvested_headers.pop()
 
+    def _harvest(self):
+        """Call `_get_uncached`, unless one timed out less than
+        `harvest_retry_interval` ago
+
+        @raises HarvestTimeoutError: On timeout or while waiting to retry.
+        """
+        if self._harvest_failed_at is not None and time.time() < (
+                self._harvest_failed_at +
+                self.harvest_retry_interval.total_seconds()):
+            raise HarvestTimeoutError("Harvest timed out recently. "
+                                      "Not retrying yet.")
+        try:
+            return self._get_uncached()
+        except HarvestTimeoutError:
+            self._harvest_failed_at = time.time()
+            raise
+
+    def get_generation(self):
+        """Return a number which changes whenever different headers are saved
+
+        Cheap enough to call before every request: the counter is only
+        re-read if some other connection has committed to the cache since
+        the last call, as reported by ``PRAGMA data_version``.
+        """
+        row = self.cache_conn.execute("PRAGMA data_version").fetchone()
+        version = row and row[0]  # (None if SQLite predates the pragma)
+        if version is None or version != self._data_version:
+            self._data_version = version
+            row = self.cache_conn.execute(
+                "SELECT value FROM cache_meta WHERE key = 'generation'"
+            ).fetchone()
+            self._generation = row[0] if row else 0
+        return self._generation
+
+    def has_changed(self, since):
+        """Return whether the cached headers differ from generation `since`
+
+        (``since`` being a value previously returned by `get_generation`)
+        """
+        return self.get_generation() != since
+
+    def watch(self, callback, interval=1.0):
+        """Start and return a `CacheWatcher` for this getter's cache"""
+        watcher = CacheWatcher(self, callback, interval)
+        watcher.start()
+        return watcher
+
+    def _get_snapshot(self):
+        """Return the `preload` snapshot (or None), reloading it once it
+        has outlived `cache_timeout`"""
+        if self._preloaded and time.time() >= self._preloaded[2]:
+            self.preload()
+        return self._preloaded
+
+    def _get_preloaded(self, index):
+        """Return a copy of part of the `preload` snapshot (or None)"""
+        snapshot = self._get_snapshot()
+        return snapshot[index].copy() if snapshot else None
+
     def get_all(self, headers=None, skip_cache=False):
         """Get all headers which are safe to reuse (ie. not cookies)"""
+        if not headers and self._preloaded and not skip_cache:
+            return self._get_preloaded(0)
         if not headers:
             headers = self._get_cache() if not skip_cache else {}
+            if not headers:
+                try:
+                    headers = self._harvest()
+                except HarvestTimeoutError:
+                    # Fall back without saving, so a later call will retry
+                    headers = self._get_cache() or self.default_headers
+                    if not headers:
+                        raise
+                    return self._filter_headers(headers)
 
             self.clear_expired()
-            headers = headers or self._get_uncached()
             self._save_cache(headers)
 
         return self._filter_headers(headers)
 
     def get_safe(self, headers=None, skip_cache=False):
         """Get all headers which should have no or beneficial effects."""
+        if not headers and self._preloaded and not skip_cache:
+            return self._get_preloaded(1)
         headers = headers or self.get_all(skip_cache=skip_cache)
 
         return {key: value for key, value
                 in self.normalize_header_names(headers).items()
-                if key in self.safe_headers}
+                if key in self.safe_policy}
+
+    def set_overlay(self, host, headers):
+        """Set the headers `get_overlay` should override for ``host``.
+
+        The names are normalized once, here. A value of None removes that
+        header from ``host``'s view.
+        """
+        host = host.lower()
+        self._overlays[host] = self.normalize_header_names(headers)
+        self._overlay_views.pop(host, None)
+
+    def get_overlay(self, host):
+        """Return ``host``'s `HeaderOverlay` on top of `get_safe`.
+
+        Views are built once per host and share a single base dict. They're
+        all rebuilt the first time they're requested after the cache's
+        generation changes (see `get_generation`) or, while `preload` is in
+        effect, after the snapshot is replaced. (In which case SQLite isn't
+        touched at all.)
+        """
+        source = self._get_snapshot()
+        if source is not None:
+            stale = source is not self._overlay_source
+        else:
+            # (Read before get_safe(), so a save in between causes a rebuild)
+            source = self.get_generation()
+            stale = (isinstance(self._overlay_source, tuple) or
+                     source != self._overlay_source)
+        if stale:
+            self._overlay_base = self.get_safe()
+            self._overlay_source = source
+            self._overlay_views = {}
+
+        host = host.lower()
+        if host not in self._overlay_views:
+            self._overlay_views[host] = HeaderOverlay(
+                self._overlay_base, self._overlays.get(host))
+        return self._overlay_views[host]
+
+    def preload(self, enable=True, skip_cache=False):
+        """Hold the current headers in memory for `get_all` and `get_safe`.
+
+        Afterward, calls which would otherwise read the cache are answered
+        from memory without touching SQLite. Call this before forking a
+        `multiprocessing` pool and the workers will share the loaded headers
+        copy-on-write rather than each opening the cache.
+
+        The snapshot doesn't see changes made by other processes. It is
+        reloaded once it is `cache_timeout` old. Call ``preload(False)`` to
+        drop it and go back to reading the cache on every call.
+        """
+        self._preloaded = None
+        if enable:
+            headers = self.get_all(skip_cache=skip_cache)
+            self._preloaded = (headers, self.get_safe(headers), time.time() +
+                               self.cache_timeout.total_seconds())
+
+    def filter_stream(self, records, safe_only=False, processes=1,
+                      batch_size=1000):
+        """Lazily normalize and filter an iterable of header dicts.
+
+        Yields one dict per input record, in order, filtered as `get_all`
+        would (or as `get_safe` would if ``safe_only`` is set). Neither the
+        cache nor the browser is consulted, so empty records come out empty.
+
+        If ``processes`` is greater than 1, records are handed to a
+        `multiprocessing` pool ``batch_size`` at a time, with at most two
+        batches in flight, so memory use stays bounded no matter how large
+        the input is.
+        """
+        if processes <= 1:
+            for headers in records:
+                yield self._classify_headers(headers, safe_only)
+            return
+
+        records = iter(records)
+        pool = multiprocessing.Pool(processes, _init_stream_worker, (self,))
+        try:
+            pending = None
+            while True:
+                batch, error = [], None
+                try:
+                    for headers in itertools.islice(records, batch_size):
+                        batch.append((headers, safe_only))
+                except Exception as err:  # pylint: disable=broad-except
+                    error = err  # Emit the records preceding it first
+                job = batch and pool.map_async(_stream_worker, batch)
+                if pending:
+                    for result in pending.get():
+                        yield result
+                if error is not None:
+                    for result in job.get() if job else ():
+                        yield result
+                    raise error
+                if not job:
+                    break
+                pending = job
+        finally:
+            pool.terminate()
+            pool.join()
 
     @staticmethod
     def _init_httpd_on_random(request_handler):
@@ -333,20 +760,569 @@ class UserHeaderGetter(object):
         """
         # TODO: Consider using my titlecase_up() function from game_launcher to
         # prevent acronyms from getting converted back to titlecase.
-        known = {x.lower(): x for x in self.known_headers}
+        known = self._known_lowercase
         return {known.get(x.lower(), x.title()): y for x, y in headers.items()}
 
     def _save_cache(self, headers):
         """Save given headers to the cache.
 
+        Bumps the generation number if that changes any stored name or value.
+        (Not on every call, since `get_all` re-saves to refresh expiry.)
+
         NOTE: Does not clear existing headers with unlisted keys.
         """
         ts_expires = _timestamp(datetime.datetime.now() + self.cache_timeout)
-        self.cache_conn.executemany("INSERT OR REPLACE INTO user_headers ("
-            "py_version, key, value, expires) VALUES (?, ?, ?, ?)",
-            [[sys.version_info.major, x, y, ts_expires] for x, y in
-             list(headers.items())])
-        self.cache_conn.commit()
+        conn = self.cache_conn
+        try:
+            # Take the write lock before comparing so it can't go stale
+            conn.execute("BEGIN IMMEDIATE")
+            stored = {x.lower(): (x, y) for x, y in conn.execute(
+                "SELECT key, value FROM user_headers WHERE py_version = ?",
+                [sys.version_info.major])}
+            changed = any(stored.get(x.lower()) != (x, y)
+                          for x, y in headers.items())
+
+            conn.executemany("INSERT OR REPLACE INTO user_headers ("
+                "py_version, key, value, expires) VALUES (?, ?, ?, ?)",
+                [[sys.version_info.major, x, y, ts_expires] for x, y in
+                 list(headers.items())])
+            if changed:
+                conn.execute("INSERT OR REPLACE INTO cache_meta (key, value) "
+                    "VALUES ('generation', 1 + COALESCE((SELECT value FROM "
+                    "cache_meta WHERE key = 'generation'), 0))")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        if changed:  # Our own commits don't change our data_version
+            self._data_version = None
+
+class CacheWatcher(threading.Thread):
+    """Thread which calls ``callback(generation)`` when the cache changes
+
+    (Polls `UserHeaderGetter.get_generation` every ``interval`` seconds on
+     its own SQLite connection. Call `stop` to end it.)
+    """
+    def __init__(self, getter, callback, interval=1.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.generation = getter.get_generation()
+        self.getter = copy.copy(getter)  # Connects anew in the watcher thread
+        self.callback, self.interval = callback, interval
+        self._stopping = threading.Event()
+
+    def run(self):
+        try:
+            while not self._stopping.wait(self.interval):
+                if self.getter.has_changed(self.generation):
+                    self.generation = self.getter.get_generation()
+                    self.callback(self.generation)
+        finally:
+            self.getter.cache_conn.close()
+
+    def stop(self):
+        """Stop watching and wait for the thread to exit"""
+        self._stopping.set()
+        self.join()
+
+class HeaderDaemonError(Exception):
+    """Raised by `HeaderClient` when the daemon reports a failure"""
+
+class HeaderDaemonRequestHandler(socketserver.StreamRequestHandler):
+    """Request handler for answering one `HeaderClient` query.
+
+    The protocol is a single line of JSON in each direction per connection:
+    ``{"op": "all"|"safe", "headers": {...}|null, "skip_cache": bool}``
+    answered by ``{"headers": {...}}`` or ``{"error": "..."}``.
+    """
+    # Seconds to wait for a client's request line. Requests are handled one
+    # at a time, so this bounds how long a stalled client can hold up others.
+    timeout = 5
+
+    # Longest request line (in bytes) that will be accepted
+    max_request_size = 65536
+
+    def handle(self):
+        try:
+            line = self.rfile.readline(self.max_request_size + 1)
+        except socket.timeout:
+            return  # Drop stalled clients so the next one can be served
+
+        try:
+            if len(line) > self.max_request_size:
+                raise ValueError("Request exceeds {} bytes".format(
+                    self.max_request_size))
+            request = json.loads(line.decode('utf8'))
+            method = {'all': self.server.get_all,
+                      'safe': self.server.get_safe}[request['op']]
+            response = {'headers': method(request.get('headers'),
+                                          request.get('skip_cache', False))}
+        except Exception as err:  # pylint: disable=broad-except
+            response = {'error': '{}: {}'.format(type(err).__name__, err)}
+        self.wfile.write(json.dumps(response).encode('utf8') + b'\n')
+
+# (Windows has no Unix domain sockets, so HeaderDaemon is POSIX-only)
+_UNIX_SERVER = getattr(socketserver, 'UnixStreamServer', object)
+
+class HeaderDaemon(_UNIX_SERVER):
+    """Unix domain socket server which answers `HeaderClient` queries.
+
+    Owns a single `UserHeaderGetter` (and thus the only SQLite connection),
+    so harvesting happens once per host rather than once per process and
+    answers are served from memory between refreshes.
+
+    Requests are handled one at a time, in the thread which calls
+    `serve_forever`, so the getter must have been created in that thread.
+    A getter passed in is used as configured, so it should have a
+    `UserHeaderGetter.harvest_timeout`, since every client waits while the
+    daemon harvests.
+    """
+    # How often to re-read the SQLite cache (and expire it) in seconds
+    refresh_interval = 60
+
+    # `UserHeaderGetter.harvest_timeout` for a getter the daemon creates
+    harvest_timeout = 300
+
+    def __init__(self, socket_path=None, getter=None):
+        if _UNIX_SERVER is object:  # pragma: no cover
+            raise OS_ERROR(errno.EAFNOSUPPORT,
+                           "Unix domain sockets are not supported")
+
+        if getter is None:
+            getter = UserHeaderGetter()
+            getter.harvest_timeout = self.harvest_timeout
+        self.getter = getter
+        self.socket_path = socket_path or default_socket_path(
+            os.path.dirname(self.getter.cache_path))
+        self._cached = None, None
+        self._expires = 0
+
+        _remove_stale_socket(self.socket_path)
+
+        # Headers identify the user, so the socket must never be reachable by
+        # anyone else, even briefly. (NOTE: The umask is process-wide.)
+        old_umask = os.umask(0o177)
+        try:
+            _UNIX_SERVER.__init__(self, self.socket_path,
+                                  HeaderDaemonRequestHandler)
+        finally:
+            os.umask(old_umask)
+
+    def get_all(self, headers=None, skip_cache=False):
+        """Same as `UserHeaderGetter.get_all` but memoized between refreshes
+        """
+        if headers:
+            return self.getter.get_all(headers)
+        return self._refresh(skip_cache)[0]
+
+    def get_safe(self, headers=None, skip_cache=False):
+        """Same as `UserHeaderGetter.get_safe` but memoized between refreshes
+        """
+        if headers:
+            return self.getter.get_safe(headers)
+        return self._refresh(skip_cache)[1]
+
+    def _refresh(self, skip_cache=False):
+        """Return ``(all, safe)``, re-querying the getter if necessary"""
+        if skip_cache or time.time() >= self._expires:
+            headers = self.getter.get_all(skip_cache=skip_cache)
+            self._cached = headers, self.getter.get_safe(headers)
+            self._expires = time.time() + self.refresh_interval
+        return self._cached
+
+    def server_close(self):
+        """Close the listening socket and remove it from the filesystem"""
+        _UNIX_SERVER.server_close(self)
+        _remove_stale_socket(self.socket_path)
+
+class HeaderClient(object):
+    """Stand-in for `UserHeaderGetter` which queries a `HeaderDaemon`"""
+    # Seconds to wait for the daemon. (None, because answering may require
+    # a harvest, which the daemon bounds with its own harvest_timeout.)
+    timeout = None
+
+    def __init__(self, socket_path=None):
+        self.socket_path = socket_path or default_socket_path()
+
+    def _request(self, operation, headers, skip_cache):
+        """Send one request to the daemon and return the decoded answer"""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+            sock.sendall(json.dumps({'op': operation, 'headers': headers,
+                'skip_cache': skip_cache}).encode('utf8') + b'\n')
+            rfile = sock.makefile('rb')
+            try:
+                response = json.loads(rfile.readline().decode('utf8'))
+            finally:
+                rfile.close()
+        finally:
+            sock.close()
+
+        if 'error' in response:
+            raise HeaderDaemonError(response['error'])
+        return response['headers']
+
+    def get_all(self, headers=None, skip_cache=False):
+        """Get all headers which are safe to reuse (ie. not cookies)"""
+        return self._request('all', headers, skip_cache)
+
+    def get_safe(self, headers=None, skip_cache=False):
+        """Get all headers which should have no or beneficial effects."""
+        return self._request('safe', headers, skip_cache)
+
+def default_socket_path(path=None):
+    """Return the daemon socket path for the given cache directory"""
+    return os.path.join(path or CACHE_DIR, 'daemon.sock')
+
+def _remove_stale_socket(path):
+    """Remove a Unix domain socket left behind by a dead `HeaderDaemon`
+
+    @raises OSError: A daemon is still listening on C{path} or C{path} is
+        something other than a socket.
+    """
+    try:
+        mode = os.stat(path).st_mode
+    except OS_ERROR as err:
+        if err.errno == errno.ENOENT:
+            return
+        raise
+    if not stat.S_ISSOCK(mode):
+        raise OS_ERROR(errno.EEXIST, "Refusing to replace a non-socket", path)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        os.remove(path)
+    else:
+        raise OS_ERROR(errno.EADDRINUSE,
+                       "A HeaderDaemon is already listening", path)
+    finally:
+        sock.close()
+
+def _parse_http_date(value):
+    """Parse an HTTP date into a POSIX timestamp (or None if invalid)"""
+    parsed = parsedate_tz(value) if value else None
+    return mktime_tz(parsed) if parsed else None
+
+def _freshness_lifetime(headers):
+    """Return how many seconds a response may be reused without revalidation
+
+    Follows RFC 7234 for a private cache: ``no-store`` yields None (don't
+    store), ``no-cache`` yields 0, ``max-age`` beats ``Expires``, and there
+    is no heuristic freshness, so responses without explicit freshness
+    information are always revalidated.
+    """
+    headers = {x.lower(): y for x, y in headers.items()}
+    directives = {}
+    for directive in headers.get('cache-control', '').split(','):
+        name, _, value = directive.strip().partition('=')
+        directives[name.lower()] = value.strip('"')
+
+    if 'no-store' in directives:
+        return None
+    if 'no-cache' in directives:
+        return 0
+
+    age = headers.get('age', '')
+    age = int(age) if age.isdigit() else 0
+    if directives.get('max-age', '').isdigit():
+        return max(0, int(directives['max-age']) - age)
+
+    expires = _parse_http_date(headers.get('expires'))
+    if expires is not None:
+        date = _parse_http_date(headers.get('date')) or time.time()
+        return max(0, expires - date - age)
+    return 0
+
+CachedResponse = collections.namedtuple('CachedResponse',
+                                        'url status headers body from_cache')
+
+class ResponseCache(_SQLiteStore):
+    """Disk-backed HTTP response cache which revalidates conditionally.
+
+    Stores bodies and validators (``ETag``, ``Last-Modified``) in SQLite
+    alongside `UserHeaderGetter`'s cache, serves fresh responses without
+    touching the network, and turns ``304 Not Modified`` answers to
+    ``If-None-Match``/``If-Modified-Since`` requests into cache hits.
+
+    One response is kept per URL. If it has a ``Vary`` header, it's only
+    used for requests which agree with the stored one on the headers named.
+
+    If given a ``getter``, requests are built on top of its `get_safe`
+    headers.
+    """
+    cache_schema = """
+        CREATE TABLE IF NOT EXISTS responses (
+            url TEXT PRIMARY KEY,
+            status INTEGER NOT NULL,
+            headers TEXT NOT NULL,
+            body BLOB NOT NULL,
+            fresh_until REAL NOT NULL,
+            selecting_headers TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS response_stats (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+    """
+    stat_names = ('requests', 'requests_saved', 'revalidated', 'bytes_saved')
+
+    # Headers (lowercase) which a 304 response must not update in the stored
+    # one: Content-Length and hop-by-hop headers. (RFC 9111 section 3.2)
+    unupdatable_headers = frozenset(['connection', 'content-length',
+        'keep-alive', 'proxy-connection', 'te', 'trailer',
+        'transfer-encoding', 'upgrade'])
+
+    def __init__(self, path=None, getter=None):
+        self.cache_path = os.path.join(path or CACHE_DIR, 'responses.sqlite3')
+        self.getter = getter
+        self._create_store()
+
+    @staticmethod
+    def _selecting_headers(response_headers, request_headers):
+        """Return the request headers named by a response's ``Vary`` header
+
+        @returns: A dict mapping lowercase names to values (or None if the
+                  request didn't send that header), or None for
+                  ``Vary: *``, which no later request can match.
+        """
+        vary = ','.join(y for x, y in response_headers.items()
+                        if x.lower() == 'vary')
+        request_headers = {x.lower(): y for x, y in request_headers.items()}
+        names = set(x.strip().lower() for x in vary.split(',') if x.strip())
+        if '*' in names:
+            return None
+        return {x: request_headers.get(x) for x in names}
+
+    def _update_headers(self, stored, update):
+        """Merge the headers of a 304 response into the stored ones
+
+        (Names are compared case-insensitively and `unupdatable_headers`,
+         plus any named by the 304's ``Connection`` header, are left alone)
+        """
+        skipped = set(self.unupdatable_headers)
+        for name, value in update.items():
+            if name.lower() == 'connection':
+                skipped.update(x.strip().lower() for x in value.split(','))
+        update = {x: y for x, y in update.items() if x.lower() not in skipped}
+
+        updated = set(x.lower() for x in update)
+        result = {x: y for x, y in stored.items() if x.lower() not in updated}
+        result.update(update)
+        return result
+
+    def _request_headers(self, headers=None):
+        """Return `get_safe` headers (if there's a getter) plus ``headers``
+        """
+        result = self.getter.get_safe() if self.getter else {}
+        result.update(headers or {})
+        return result
+
+    def _lookup(self, url, request_headers):
+        """Return the cached C{(status, headers, body, fresh_until)} or None
+
+        (Entries whose ``Vary`` headers don't match ``request_headers`` are
+         treated as missing, so they're neither served nor revalidated)
+        """
+        row = self.cache_conn.execute("SELECT status, headers, body, "
+            "fresh_until, selecting_headers FROM responses WHERE url = ?",
+            [url]).fetchone()
+        if row:
+            headers = json.loads(row[1])
+            if json.loads(row[4]) == self._selecting_headers(headers,
+                                                             request_headers):
+                return row[0], headers, bytes(row[2]), row[3]
+        return None
+
+    def _store(self, url, status, headers, body, request_headers):
+        """Cache a response, unless its headers forbid it
+
+        (Like `_count`, this leaves committing to the caller)
+        """
+        lifetime = _freshness_lifetime(headers)
+        selecting = self._selecting_headers(headers, request_headers)
+        if lifetime is None or selecting is None:
+            self.cache_conn.execute("DELETE FROM responses WHERE url = ?",
+                                    [url])
+        else:
+            self.cache_conn.execute("INSERT OR REPLACE INTO responses ("
+                "url, status, headers, body, fresh_until, selecting_headers) "
+                "VALUES (?, ?, ?, ?, ?, ?)", [url, status, json.dumps(headers),
+                sqlite3.Binary(body), time.time() + lifetime,
+                json.dumps(selecting)])
+
+    def _count(self, **increments):
+        """Add to the persistent statistics reported by `stats`
+
+        (Left uncommitted so it can share a transaction with `_store`)
+        """
+        self.cache_conn.executemany("INSERT OR REPLACE INTO response_stats "
+            "(key, value) VALUES (?, ? + COALESCE((SELECT value FROM "
+            "response_stats WHERE key = ?), 0))",
+            [[x, y, x] for x, y in increments.items()])
+
+    @staticmethod
+    def _add_validators(request_headers, cached):
+        """Add validators from a `_lookup` result to ``request_headers``"""
+        if cached:
+            cached_headers = {x.lower(): y for x, y in cached[1].items()}
+            if 'etag' in cached_headers:
+                request_headers['If-None-Match'] = cached_headers['etag']
+            if 'last-modified' in cached_headers:
+                request_headers['If-Modified-Since'] = (
+                    cached_headers['last-modified'])
+        return request_headers
+
+    def conditional_headers(self, url, headers=None):
+        """Return request headers for ``url``, with cache validators added
+
+        (Layered as `get_safe` headers, then ``headers``, then validators)
+        """
+        request_headers = self._request_headers(headers)
+        return self._add_validators(request_headers,
+                                    self._lookup(url, request_headers))
+
+    def fetch(self, url, headers=None):
+        """Retrieve ``url``, from the cache whenever HTTP semantics allow
+
+        @returns: A L{CachedResponse} whose C{from_cache} is True if no body
+                  had to be downloaded.
+        @raises urllib2.HTTPError: For error statuses (via ``urllib``)
+        """
+        counts = {'requests': 1}
+        try:
+            return self._fetch(url, headers, counts)
+        finally:
+            # Record the statistics in the same commit as any update
+            self._count(**counts)
+            self.cache_conn.commit()
+
+    def _fetch(self, url, headers, counts):
+        """Implementation of `fetch` which adds to ``counts`` for `_count`
+        """
+        request_headers = self._request_headers(headers)
+        cached = self._lookup(url, request_headers)
+        if cached and cached[3] > time.time():
+            counts.update(requests_saved=1, bytes_saved=len(cached[2]))
+            return CachedResponse(url, cached[0], cached[1], cached[2], True)
+
+        request = urllib_request.Request(url,
+            headers=self._add_validators(dict(request_headers), cached))
+        try:
+            response = urllib_request.urlopen(request)
+        except urllib_request.HTTPError as err:
+            err.close()
+            if err.code != 304 or not cached:
+                raise
+
+            # Not Modified responses update the stored metadata
+            status, new_headers, body = cached[:3]
+            new_headers = self._update_headers(new_headers,
+                                               dict(err.headers.items()))
+            self._store(url, status, new_headers, body, request_headers)
+            counts.update(revalidated=1, bytes_saved=len(body))
+            return CachedResponse(url, status, new_headers, body, True)
+
+        try:
+            status, body = response.getcode(), response.read()
+            new_headers = dict(response.info().items())
+        finally:
+            response.close()
+        if status == 200:  # (eg. Don't mistake 206 Partial Content for all)
+            self._store(url, status, new_headers, body, request_headers)
+        return CachedResponse(url, status, new_headers, body, False)
+
+    def stats(self):
+        """Return counts of requests and bytes the cache has saved so far
+
+        (``requests_saved`` counts fetches answered without contacting the
+         server, ``revalidated`` counts ``304 Not Modified`` answers, and
+         ``bytes_saved`` counts body bytes which didn't need downloading.)
+        """
+        result = dict.fromkeys(self.stat_names, 0)
+        result.update(self.cache_conn.execute(
+            "SELECT key, value FROM response_stats"))
+        return result
+
+_STREAM_GETTER = None  # Set in filter_stream() worker processes
+
+def _init_stream_worker(getter):
+    """Initializer for filter_stream() worker processes"""
+    global _STREAM_GETTER  # pylint: disable=global-statement
+    _STREAM_GETTER = getter
+
+def _stream_worker(args):
+    """Unit of work for filter_stream() worker processes"""
+    return _STREAM_GETTER._classify_headers(*args)
+
+def _record_headers(record):
+    """Extract a dict of request headers from a parsed input record.
+
+    Accepts a HAR entry (``{"request": {"headers": [...]}}``), a bare list
+    of HAR-style ``{"name": ..., "value": ...}`` pairs, or a plain dict.
+
+    @raises ValueError: The record isn't in any of those formats.
+    """
+    if isinstance(record, dict) and 'request' in record:
+        record = (record['request'] or {}).get('headers', [])
+    if isinstance(record, list):
+        try:
+            return {x['name']: x['value'] for x in record}
+        except (KeyError, TypeError):
+            raise ValueError("Expected a list of name/value pairs")
+    if not isinstance(record, dict):
+        raise ValueError("Expected a JSON object or list, not %s" %
+                         type(record).__name__)
+    return record
+
+def _iter_records(records, source, on_error):
+    """Apply `_record_headers` to C{(location, record_thunk)} pairs,
+    reporting failures as C{source:location: message}."""
+    for location, thunk in records:
+        try:
+            yield _record_headers(thunk())
+        except ValueError as err:
+            err = RecordError("%s:%s: %s" % (source, location, err))
+            if on_error is None:
+                raise err
+            on_error(err)
+
+def iter_jsonl_headers(lines, source='<input>', on_error=None):
+    """Yield a dict of request headers for each non-blank JSON-lines record.
+
+    (See `_record_headers` for the accepted record formats)
+
+    @param source: The file name to use when reporting malformed records.
+    @param on_error: If C{None}, a malformed record raises `RecordError`.
+        Otherwise, it's called with the `RecordError` and the record is
+        skipped.
+    """
+    return _iter_records(((num, lambda line=line: json.loads(line))
+                          for num, line in enumerate(lines, 1)
+                          if line.strip()), source, on_error)
+
+def iter_har_headers(fobj, source='<input>', on_error=None):
+    """Yield a dict of request headers for each entry in a HAR file.
+
+    (Malformed entries are reported as for `iter_jsonl_headers`, using
+    their index within C{log.entries} as the location)
+
+    NOTE: HAR is a single JSON document, so the standard library has to
+          parse all of it up front. Convert very large captures to
+          JSON-lines (one entry per line) to keep memory use bounded.
+    """
+    try:
+        entries = json.load(fobj)['log']['entries']
+    except (ValueError, KeyError, TypeError) as err:
+        raise RecordError("%s: Not a HAR file: %s" % (source, err))
+    return _iter_records(((
+        'entry %d' % num, lambda entry=entry: entry)
+        for num, entry in enumerate(entries, 1)), source, on_error)
 
 def randomize_delay(base_delay=DEFAULT_BASE_DELAY):
     """Return a time to wait in floating-point seconds to disguise automation.
@@ -374,8 +1350,16 @@ def randomize_delay(base_delay=DEFAULT_BASE_DELAY):
     return base_delay * random.SystemRandom().uniform(0.5, 1.5)
 
 
-if __name__ == '__main__':  # pragma: no cover
-    getter = UserHeaderGetter()
+def _make_getter(args):  # pragma: no cover
+    """Construct a `UserHeaderGetter` according to the common options"""
+    getter = UserHeaderGetter(args.cache_dir)
+    if args.harvest_timeout is not None:
+        getter.harvest_timeout = args.harvest_timeout
+    return getter
+
+def _cmd_show(args):  # pragma: no cover
+    """Implementation of the default ``show`` subcommand"""
+    getter = _make_getter(args)
     headers = getter.get_all()
     safe_headers = getter.get_safe(headers)
 
@@ -389,4 +1373,97 @@ if __name__ == '__main__':  # pragma: no cover
     prettyprint("\nSafe headers harvested from user's default browser:",
                 safe_headers)
 
+def _cmd_filter(args):
+    """Implementation of the ``filter`` subcommand"""
+    getter = UserHeaderGetter.filter_only()
+    parse = iter_har_headers if args.har else iter_jsonl_headers
+
+    def report(err):
+        """Warn about a skipped record"""
+        sys.stderr.write("Skipping record: %s\n" % err)
+
+    def records():
+        """Chain the records from all input files together"""
+        for path in args.files or ['-']:
+            if path == '-':
+                fobj = io.open(sys.stdin.fileno(), encoding='utf-8',
+                               closefd=False)
+                source = '<stdin>'
+            else:
+                fobj, source = io.open(path, encoding='utf-8'), path
+            with fobj:
+                for headers in parse(fobj, source,
+                                     report if args.skip_errors else None):
+                    yield headers
+
+    try:
+        for headers in getter.filter_stream(records(), safe_only=args.safe,
+                                            processes=args.processes):
+            sys.stdout.write(json.dumps(headers, sort_keys=True) + '\n')
+    except RecordError as err:
+        sys.exit("Error: %s" % err)
+
+def _cmd_daemon(args):  # pragma: no cover
+    """Implementation of the ``daemon`` subcommand"""
+    getter = _make_getter(args)
+    if getter.harvest_timeout is None:
+        getter.harvest_timeout = HeaderDaemon.harvest_timeout
+    daemon = HeaderDaemon(args.socket, getter)
+    try:
+        daemon.get_all()  # Harvest (if necessary) before accepting clients
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server_close()
+
+def main(argv=None):
+    """Entry point when run as a script"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--cache-dir', default=None,
+        help="Directory to hold the header cache (default: %(default)s)")
+    parser.add_argument('--harvest-timeout', type=float, default=None,
+        help="Seconds to wait for the browser before falling back to stale "
+             "cached headers (default: wait forever, or {}s when running "
+             "as a daemon)".format(HeaderDaemon.harvest_timeout))
+    parser.set_defaults(func=_cmd_show)
+    subparsers = parser.add_subparsers()
+
+    show = subparsers.add_parser('show',
+        help="Harvest (if necessary) and display headers (default)")
+    show.set_defaults(func=_cmd_show)
+
+    filt = subparsers.add_parser('filter',
+        help="Stream JSON-lines or HAR input through the header policy and "
+             "write one filtered JSON object per line to stdout")
+    filt.add_argument('files', nargs='*', metavar='FILE',
+        help="Input files (default: stdin)")
+    filt.add_argument('--har', action='store_true',
+        help="Inputs are HAR files rather than JSON-lines")
+    filt.add_argument('--safe', action='store_true',
+        help="Keep only safe headers, as get_safe() would")
+    filt.add_argument('--skip-errors', action='store_true',
+        help="Warn about malformed records and skip them rather than "
+             "stopping at the first one")
+    filt.add_argument('-j', '--processes', type=int, default=1,
+        help="Number of worker processes (default: %(default)s, this "
+             "machine has {})".format(multiprocessing.cpu_count()))
+    filt.set_defaults(func=_cmd_filter)
+
+    daemon = subparsers.add_parser('daemon',
+        help="Own the header cache and serve it to HeaderClient instances "
+             "over a Unix domain socket")
+    daemon.add_argument('--socket', default=None,
+        help="Path of the socket to listen on (default: daemon.sock in the "
+             "cache directory)")
+    daemon.set_defaults(func=_cmd_daemon)
+
+    # (Python 2.x's argparse has no concept of an optional subcommand)
+    argv = sys.argv[1:] if argv is None else argv
+    args = parser.parse_args(argv or ['show'])
+    args.func(args)
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
+
 # vim: set sw=4 sts=4 expandtab :
@@ -7,8 +7,19 @@ from __future__ import (absolute_import, division, print_function,
 __author__ = "Stephan Sokolow (deitarion/SSokolow)"
 __license__ = "MIT"
 
-import datetime, locale, math, os, platform, random, shutil, socket, sqlite3
-import sys, tempfile, threading, unittest
+import argparse, datetime, json, locale, math, multiprocessing, os, platform
+import random, shutil, socket, sqlite3, sys, tempfile, threading, time, timeit
+import io, unittest
+
+try:
+    from StringIO import StringIO
+except ImportError:  # pragma: no cover
+    from io import StringIO
+
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
 
 try:
     from unittest.mock import patch, ANY  # pylint: disable=no-name-in-module
@@ -75,6 +86,141 @@ class MockBrowser(threading.Thread):
         """Wrapper to adapt Thread's API to webbrowser_open mocking"""
         cls([url]).start()
 
+class SoakHeaderGetter(get_user_headers.UserHeaderGetter):
+    """UserHeaderGetter with a local stand-in for the browser harvest"""
+    cache_timeout = datetime.timedelta(seconds=1)  # Keep expiry in play
+    soak_headers = {'Accept': '*/*', 'User-Agent': 'soak-agent'}
+
+    def _get_uncached(self):
+        return self.soak_headers.copy()
+
+def soak_worker(path, duration, results):
+    """Hammer the cache in `path` with a random mix of operations
+
+    (Runs in each soak thread or process and always reports back a
+     C{(latencies, lock_errors, failure)} tuple via `results`)
+    """
+    latencies, errors, failure = [], 0, None
+    rng, getter = random.Random(), None
+    deadline = timeit.default_timer() + duration
+    try:
+        while timeit.default_timer() < deadline:
+            start = timeit.default_timer()
+            try:
+                getter = getter or SoakHeaderGetter(path)
+                rng.choice([
+                    getter.get_all,
+                    getter.get_safe,
+                    getter.clear_expired,
+                    lambda: getter._save_cache(getter.soak_headers),
+                    lambda: getter.get_all(skip_cache=True),
+                ])()
+            except sqlite3.OperationalError:
+                errors += 1
+            else:
+                latencies.append(timeit.default_timer() - start)
+    except Exception as err:  # pylint: disable=broad-except
+        failure = '{}: {}'.format(type(err).__name__, err)
+    finally:
+        if getter:
+            getter.cache_conn.close()
+        results.put((latencies, errors, failure))
+
+def check_soak_consistency(path):
+    """Return whether the cache in `path` survived a soak test intact"""
+    conn = sqlite3.connect(os.path.join(path, 'cache.sqlite3'))
+    try:
+        integrity = conn.execute("PRAGMA integrity_check").fetchone()[0]
+        rows = list(conn.execute("SELECT key, value FROM user_headers"))
+    finally:
+        conn.close()
+    return integrity == 'ok' and all(
+        SoakHeaderGetter.soak_headers.get(key) == value for key, value in rows)
+
+def run_soak(path, threads=4, processes=2, duration=1.0):
+    """Drive many threads and processes against one cache concurrently.
+
+    @returns: A C{dict} of throughput, latency, and error statistics.
+    """
+    # Generous, since each operation may wait out SQLite's 5s busy timeout
+    result_timeout = duration + 30
+
+    # Fork the processes before any soak thread holds an SQLite connection
+    thread_results = queue.Queue()
+    process_results = multiprocessing.Queue()
+    proc_workers = [
+        multiprocessing.Process(target=soak_worker,
+                                args=(path, duration, process_results))
+        for _ in range(processes)]
+    thread_workers = [threading.Thread(target=soak_worker,
+                                       args=(path, duration, thread_results))
+                      for _ in range(threads)]
+
+    started = timeit.default_timer()
+    for worker in proc_workers + thread_workers:
+        worker.start()
+
+    # Drain the process queue before joining to avoid a pipe deadlock
+    results = [process_results.get(timeout=result_timeout)
+               for _ in proc_workers]
+    results += [thread_results.get(timeout=result_timeout)
+                for _ in thread_workers]
+    elapsed = timeit.default_timer() - started
+    for worker in proc_workers + thread_workers:
+        worker.join()
+
+    latencies = sorted(x for result in results for x in result[0])
+    return {
+        'operations': len(latencies),
+        'throughput': len(latencies) / elapsed,
+        'p50': latencies[int(len(latencies) * 0.50)] if latencies else None,
+        'p99': latencies[int(len(latencies) * 0.99)] if latencies else None,
+        'errors': sum(result[1] for result in results),
+        'failures': [result[2] for result in results if result[2]],
+        'consistent': check_soak_consistency(path),
+    }
+
+class MockOriginHandler(get_user_headers.http_server.BaseHTTPRequestHandler):
+    """Local stand-in for a website with various caching policies"""
+    body = b'<html>Hello, World!</html>'
+    last_modified = 'Sat, 16 Jul 2016 12:58:43 GMT'
+    responses = {
+        '/fresh': {'Cache-Control': 'max-age=3600', 'ETag': '"v1"'},
+        '/etag': {'Cache-Control': 'no-cache', 'ETag': '"v1"'},
+        '/lastmod': {'Last-Modified': last_modified},
+        '/expired': {'Expires': 'Thu, 01 Jan 1970 00:00:00 GMT'},
+        '/nostore': {'Cache-Control': 'no-store', 'ETag': '"v1"'},
+        '/vary': {'Cache-Control': 'max-age=3600', 'ETag': '"v1"',
+                  'Vary': 'Accept-Language'},
+    }
+    # Sent with every 304 (Lowercase, as HTTP/2 servers send them)
+    not_modified_headers = {'content-length': '0', 'x-version': 'v2'}
+
+    def do_GET(self):  # NOQA pylint: disable=invalid-name
+        """Answer with a 304 if the request's validators match"""
+        self.server.seen.append((self.path, self.headers))
+        headers = self.responses[self.path]
+        not_modified = (
+            self.headers.get('If-None-Match', 1) == headers.get('ETag') or
+            self.headers.get('If-Modified-Since') == self.last_modified)
+
+        self.send_response(304 if not_modified else 200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if not_modified:
+            for name, value in self.not_modified_headers.items():
+                self.send_header(name, value)
+        else:
+            self.send_header('Content-Length', str(len(self.body)))
+            self.send_header('X-Version', 'v1')
+        self.end_headers()
+        if not not_modified:
+            self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        """Silence the usual logging messages"""
+        pass
+
 def test_default_randomize_delay():
     """randomize_delay(): 1 <= randomize_delay() <= 1.5"""
     results = [get_user_headers.randomize_delay() for _ in range(0, 10000)]
@@ -111,6 +257,32 @@ def test_timestamp_recent():
     """_timestamp(): round-trips correctly at a typical time"""
     check_timestamp_roundtrip(1468673923)
 
+class HeaderPolicyTests(unittest.TestCase):
+    """Tests for HeaderPolicy"""
+    policy = get_user_headers.HeaderPolicy(['DNT', 'X-Foo.Bar'],
+        prefixes=['Sec-Fetch-'], patterns=[r'X-(?:Csrf|Xsrf)-Token'])
+
+    def test_matching(self):
+        """HeaderPolicy: names, prefixes, and patterns match case-blindly"""
+        for name in ('DNT', 'dnt', 'X-Foo.Bar', 'Sec-Fetch-Mode',
+                     'sec-fetch-site', 'X-CSRF-TOKEN', 'x-xsrf-token'):
+            self.assertIn(name, self.policy)
+
+        # Names are escaped and everything must match the whole name
+        for name in ('DNT2', 'XDNT', 'X-FooXBar', 'Sec-Fetch',
+                     'Sec-Fetch_Mode', 'X-Csrf-Token2', ''):
+            self.assertNotIn(name, self.policy)
+        self.assertNotIn('DNT', get_user_headers.HeaderPolicy())
+
+    def test_decision_cache(self):
+        """HeaderPolicy: decision cache is bounded"""
+        policy = self.policy.extend(prefixes=['X-Testing-'])
+        for idx in range(policy.cache_size * 2 + 1):
+            self.assertIn('X-Testing-{}'.format(idx), policy)
+            self.assertLessEqual(len(policy._decisions), policy.cache_size)
+        self.assertIn('DNT', policy)
+        self.assertIn('x-csrf-token', policy)
+
 class UserHeaderGetterBase(unittest.TestCase):
     """Base class for UserHeaderGetter tests.
 
@@ -369,6 +541,159 @@ class UserHeaderGetterTests1(UserHeaderGetterBase):
             wb_open.assert_called_once_with(test_url)
             assert not popen.called
 
+    @unittest.skipUnless(hasattr(os, 'fork'), "Requires os.fork()")
+    def test_fork_reconnect(self):
+        """UserHeaderGetter: reopens its SQLite connection after a fork"""
+        self.getter._save_cache(self.test_data.copy())
+        parent_conn = self.getter.cache_conn
+
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if not pid:  # pragma: no cover
+            try:
+                success = (self.getter.cache_conn is not parent_conn and
+                           self.getter._get_cache() == self.test_data)
+                os.write(write_fd, b'1' if success else b'0')
+            finally:
+                os._exit(0)  # pylint: disable=protected-access
+
+        os.close(write_fd)
+        try:
+            self.assertEqual(os.read(read_fd, 1), b'1')
+        finally:
+            os.close(read_fd)
+            os.waitpid(pid, 0)
+        self.assertIs(self.getter.cache_conn, parent_conn)
+
+    @patch('get_user_headers.UserHeaderGetter._get_uncached', autospec=True)
+    def test_preload(self, _):
+        """UserHeaderGetter: preload() answers from memory without SQLite"""
+        self.getter._save_cache(self.test_headers.copy())
+        self.getter.preload()
+        self.getter.cache_conn.close()  # Any SQLite access will now fail
+
+        results = self.getter.get_all()
+        self.check_get_all(results)
+        results['Foo'] = 'Bar'
+        self.assertNotIn('Foo', self.getter.get_all(), "Must return copies")
+        self.check_get_safe(self.getter.get_safe())
+
+        self.assertRaises(sqlite3.ProgrammingError,
+                          self.getter.get_all, skip_cache=True)
+
+    def test_preload_expiry(self):
+        """UserHeaderGetter: preload() snapshots expire or can be dropped"""
+        self.getter._save_cache(self.test_data.copy())
+        self.getter.preload()
+
+        other = get_user_headers.UserHeaderGetter(self.tempdir)
+        try:
+            other._save_cache({'Foo': 'Changed'})
+        finally:
+            other.cache_conn.close()
+        self.assertEqual(self.getter.get_all()['Foo'], 'Bar')
+
+        with patch('get_user_headers.time.time',
+                   return_value=self.getter._preloaded[2]):
+            self.assertEqual(self.getter.get_all()['Foo'], 'Changed')
+
+        self.getter.preload(False)
+        self.assertIsNone(self.getter._preloaded)
+        self.assertEqual(self.getter.get_all()['Foo'], 'Changed')
+
+    def test_generation(self):
+        """UserHeaderGetter: generation only changes with saved content"""
+        self.assertEqual(self.getter.get_generation(), 0)
+        self.getter._save_cache(self.test_data.copy())
+        generation = self.getter.get_generation()
+        self.assertTrue(self.getter.has_changed(0))
+        self.assertFalse(self.getter.has_changed(generation))
+
+        # Re-saving the same content (as get_all() does) isn't a change
+        self.getter._save_cache(self.test_data.copy())
+        self.getter.get_all()
+        self.assertFalse(self.getter.has_changed(generation))
+
+        # ...but a change from another connection is noticed
+        other = get_user_headers.UserHeaderGetter(self.tempdir)
+        try:
+            other._save_cache({'Foo': 'Changed'})
+        finally:
+            other.cache_conn.close()
+        self.assertTrue(self.getter.has_changed(generation))
+        self.assertEqual(self.getter.get_generation(), generation + 1)
+
+    def test_watch(self):
+        """UserHeaderGetter: watch() calls back when the cache changes"""
+        changed = threading.Event()
+        generations = []
+
+        def callback(generation):
+            """Record the generation reported by the watcher"""
+            generations.append(generation)
+            changed.set()
+
+        watcher = self.getter.watch(callback, interval=0.01)
+        try:
+            self.getter._save_cache(self.test_data.copy())
+            self.assertTrue(changed.wait(5), "Watcher never called back")
+        finally:
+            watcher.stop()
+        self.assertEqual(generations, [self.getter.get_generation()])
+
+    @patch('get_user_headers.UserHeaderGetter._get_uncached', autospec=True)
+    def test_overlay(self, get_uncached):
+        """UserHeaderGetter: get_overlay() layers per-host headers"""
+        self.getter._save_cache(self.test_headers.copy())
+        self.getter.set_overlay('Example.COM', {'accept-language': 'fr',
+                                                'x-extra': 'spam',
+                                                'dnt': None})
+
+        view = self.getter.get_overlay('example.com')
+        self.assertIs(self.getter.get_overlay('EXAMPLE.com'), view)
+        self.assertEqual(view['Accept-Language'], 'fr')
+        self.assertEqual(view['X-Extra'], 'spam')
+        self.assertEqual(view['User-Agent'],
+                         self.test_headers['User-Agent'])
+        self.assertNotIn('DNT', view)
+        self.assertEqual(len(view), len(self.getter.safe_headers))  # -1 +1
+        with self.assertRaises(TypeError):
+            view['Foo'] = 'Bar'  # pylint: disable=E1137
+
+        plain = self.getter.get_overlay('example.org')
+        self.assertEqual(dict(plain), self.getter.get_safe())
+        self.assertIs(plain._base, view._base, "Base must be shared")
+
+        # Refreshing the base headers invalidates all views
+        self.getter._save_cache({'User-Agent': 'new-agent'})
+        view = self.getter.get_overlay('example.com')
+        self.assertEqual(view['User-Agent'], 'new-agent')
+        self.assertEqual(view['Accept-Language'], 'fr')
+        assert not get_uncached.called
+
+    @patch('get_user_headers.UserHeaderGetter._get_uncached', autospec=True)
+    def test_overlay_preloaded(self, _):
+        """UserHeaderGetter: get_overlay() follows preload() without SQLite"""
+        self.getter._save_cache(self.test_headers.copy())
+        self.getter.set_overlay('example.com', {'x-extra': 'spam'})
+        self.getter.preload()
+
+        with patch.object(self.getter, '_cache_conn') as no_conn:
+            view = self.getter.get_overlay('example.com')
+            self.assertIs(self.getter.get_overlay('example.com'), view)
+            self.assertEqual(view['X-Extra'], 'spam')
+            self.assertFalse(no_conn.method_calls, "Shouldn't touch SQLite")
+
+        # Replacing the snapshot invalidates all views
+        self.getter._save_cache({'User-Agent': 'new-agent'})
+        self.assertIs(self.getter.get_overlay('example.com'), view)
+        self.getter.preload()
+        view = self.getter.get_overlay('example.com')
+        self.assertEqual(view['User-Agent'], 'new-agent')
+
+        self.getter.preload(False)
+        self.assertIsNot(self.getter.get_overlay('example.com'), view)
+
 class UserHeaderGetterTests2(UserHeaderGetterBase):
     """Tests for UserHeaderGetter (part 2)
 
@@ -419,6 +744,51 @@ class UserHeaderGetterTests2(UserHeaderGetterBase):
             self.check_get_safe(results)
             assert_mock_call_count({get_uncached: 1, get_cache: 1})
 
+    def test_get_safe_policy(self):
+        """UserHeaderGetter: get_safe()/get_all() honour custom policies"""
+        extra = {'Sec-CH-UA-Arch': 'x86', 'Sec-Fetch-Mode': 'navigate',
+                 'X-Custom-Thing': 'spam'}
+        headers = self.test_headers.copy()
+        headers.update(extra)
+
+        # High-entropy client hints need Accept-CH, so aren't "safe"
+        results = self.getter.get_all(headers)
+        self.assertIn('Sec-Ch-Ua-Arch', results)
+        self.assertNotIn('Sec-Fetch-Mode', results)
+        self.assertNotIn('Sec-Ch-Ua-Arch', self.getter.get_safe(headers))
+
+        self.getter.safe_policy = self.getter.safe_policy.extend(
+            patterns=['X-Custom-.*'])
+        self.assertIn('X-Custom-Thing', self.getter.get_safe(headers))
+        self.assertNotIn('X-Custom-Thing',
+            get_user_headers.UserHeaderGetter.safe_policy)
+
+    def test_subclassed_header_sets(self):
+        """UserHeaderGetter: subclasses' header sets are honoured"""
+        class SubclassedGetter(get_user_headers.UserHeaderGetter):
+            """Subclass which customizes the header sets the old way"""
+            safe_headers = get_user_headers.UserHeaderGetter.safe_headers - \
+                set(['DNT'])
+            unsafe_headers = get_user_headers.UserHeaderGetter.unsafe_headers \
+                .union(['X-Secret'])
+            known_headers = get_user_headers.UserHeaderGetter.known_headers \
+                .union(['X-UA-Compatible'])
+
+        getter = SubclassedGetter(self.tempdir)
+        try:
+            headers = {'x-ua-compatible': 'IE=edge'}
+            self.assertEqual(getter.normalize_header_names(headers),
+                             {'X-UA-Compatible': 'IE=edge'})
+            self.assertEqual(self.getter.normalize_header_names(headers),
+                             {'X-Ua-Compatible': 'IE=edge'})
+
+            headers = {'X-Secret': 'spam', 'DNT': '1', 'Sec-Fetch-Site': 'x'}
+            self.assertEqual(getter.get_all(headers), {'DNT': '1'})
+            self.assertEqual(getter.get_safe(headers), {})
+            self.assertEqual(self.getter.get_safe(headers), {'DNT': '1'})
+        finally:
+            getter.cache_conn.close()
+
     def test_get_safe_as_filter(self):
         """UserHeaderGetter: get_safe(headers) properly filters input"""
         self.check_get_safe(self.getter.get_safe(self.test_headers.copy()))
@@ -429,6 +799,66 @@ class UserHeaderGetterTests2(UserHeaderGetterBase):
                    side_effect=MockBrowser.cls_webbrowser_open):
             self.check_success(self.getter._get_uncached())
 
+    def check_harvest_timeout(self, harvests=1, **kwargs):
+        """Run get_all() against a browser which never shows up"""
+        servers = []
+        init_httpd = self.getter._init_httpd_on_random
+
+        def record_httpd(handler):
+            """Wrapper to capture the probe server for inspection"""
+            servers.append(init_httpd(handler))
+            return servers[-1]
+
+        self.getter.harvest_timeout = 0.1
+        with patch('get_user_headers.webbrowser_open', autospec=True), \
+                patch.object(self.getter, '_init_httpd_on_random',
+                             record_httpd):
+            try:
+                return self.getter.get_all(**kwargs)
+            finally:
+                self.assertEqual([x[0].socket.fileno() for x in servers],
+                                 [-1] * harvests, "Probe server not torn down")
+
+    def test_harvest_timeout(self):
+        """UserHeaderGetter: harvest_timeout falls back or raises"""
+        self.assertRaises(get_user_headers.HarvestTimeoutError,
+                          self.check_harvest_timeout)
+
+        # Fall back without opening another tab until the retry interval
+        self.getter.default_headers = self.test_headers.copy()
+        self.check_get_all(self.check_harvest_timeout(harvests=0))
+        self.getter.harvest_retry_interval = datetime.timedelta(0)
+        self.check_get_all(self.check_harvest_timeout())
+        self.assertIsNone(self.getter._get_cache(), "Shouldn't save defaults")
+
+        # Cached entries (expired or not) take precedence over defaults
+        self.getter._save_cache(self.test_data.copy())
+        self.assertEqual(self.check_harvest_timeout(skip_cache=True),
+                         self.getter.get_all(self.test_data.copy()))
+
+    def test_harvest_timeout_stalled(self):
+        """UserHeaderGetter: a stalled browser can't outlast harvest_timeout
+        """
+        socks = []
+
+        def stalled_browser(url):
+            """Use up most of the time, then connect and send nothing"""
+            time.sleep(0.6)
+            socks.append(socket.create_connection(
+                ('localhost', int(url.rsplit(':', 1)[1]))))
+
+        self.getter.harvest_timeout = 1
+        start = timeit.default_timer()
+        try:
+            with patch('get_user_headers.webbrowser_open',
+                       side_effect=stalled_browser):
+                self.assertRaises(get_user_headers.HarvestTimeoutError,
+                                  self.getter._get_uncached)
+        finally:
+            for sock in socks:
+                sock.close()
+        self.assertLess(timeit.default_timer() - start, 1.4)
+
     def test_get_uncached_collision(self):
         """UserHeaderGetter: get_uncached() recovers from port collisions"""
         with patch('get_user_headers.random.randrange',
@@ -466,3 +896,381 @@ class UserHeaderGetterTests2(UserHeaderGetterBase):
                 self.assertRaises(socket.error, self.getter._get_uncached)
             finally:
                 get_user_headers.USABLE_PORTS = usable_orig
+
+class SoakTests(UserHeaderGetterBase):
+    """Short run of the concurrency soak harness
+
+    (Run this module directly for longer, configurable soak runs)
+    """
+
+    def test_soak(self):
+        """UserHeaderGetter: concurrent use of one cache stays consistent"""
+        report = run_soak(self.tempdir, threads=4, processes=2, duration=1)
+
+        # (Lock errors are load-dependent, so they're reported, not failed)
+        self.assertGreater(report['operations'], 0, report)
+        self.assertEqual(report['failures'], [], report)
+        self.assertTrue(report['consistent'], report)
+
+class StreamFilterTests(UserHeaderGetterBase):
+    """Tests for the bulk filtering pipeline"""
+
+    def check_filter_stream(self, **kwargs):
+        """Shared code for the in-process and multi-process tests"""
+        records = [self.test_headers.copy(), {}, self.test_data.copy()] * 3
+        results = list(self.getter.filter_stream(iter(records), **kwargs))
+
+        filt = (self.getter.get_safe if kwargs.get('safe_only')
+                else self.getter.get_all)
+        self.assertEqual(results, [filt(x) if x else {} for x in records])
+        return results
+
+    @patch('get_user_headers.UserHeaderGetter._get_uncached', autospec=True)
+    def test_filter_stream(self, get_uncached):
+        """UserHeaderGetter: filter_stream() matches get_all()/get_safe()"""
+        self.check_filter_stream()
+        self.check_filter_stream(safe_only=True)
+        assert not get_uncached.called
+
+    def test_filter_stream_multiprocess(self):
+        """UserHeaderGetter: filter_stream() works with a process pool"""
+        results = self.check_filter_stream(processes=2, batch_size=2)
+        self.check_get_all(results[0])
+
+        results = self.check_filter_stream(processes=2, safe_only=True)
+        self.check_get_safe(results[0])
+
+    def test_filter_only(self):
+        """UserHeaderGetter: filter_only() filters without any cache"""
+        getter = get_user_headers.UserHeaderGetter.filter_only()
+        self.assertIsNone(getter.cache_path)
+        self.check_get_all(getter.get_all(self.test_headers.copy()))
+        self.check_get_safe(list(getter.filter_stream(
+            [self.test_headers.copy()], safe_only=True, processes=2))[0])
+        self.assertRaises(sqlite3.ProgrammingError, getter.get_all)
+
+    def test_iter_headers(self):
+        """iter_*_headers: accept HAR entries, HAR pairs and plain dicts"""
+        pairs = [{'name': 'User-Agent', 'value': 'test-agent'},
+                 {'name': 'cookie', 'value': 'x=1'}]
+        expected = {'User-Agent': 'test-agent', 'cookie': 'x=1'}
+
+        lines = [json.dumps({'request': {'headers': pairs}}), '\n',
+                 json.dumps(pairs), json.dumps(expected)]
+        self.assertEqual(list(get_user_headers.iter_jsonl_headers(lines)),
+                         [expected] * 3)
+
+        har = StringIO(json.dumps({'log': {'entries': [
+            {'request': {'headers': pairs}}] * 2}}))
+        self.assertEqual(list(get_user_headers.iter_har_headers(har)),
+                         [expected] * 2)
+
+    def test_iter_headers_errors(self):
+        """iter_*_headers: report malformed records by file and location"""
+        lines = ['{"User-Agent": "a"}', '{bad json', '\n', '42',
+                 '[{"value": "no name"}]', '{"User-Agent": "b"}']
+        with self.assertRaises(get_user_headers.RecordError) as ctx:
+            list(get_user_headers.iter_jsonl_headers(lines, 'in.jsonl'))
+        self.assertTrue(str(ctx.exception).startswith('in.jsonl:2: '))
+
+        errors = []
+        self.assertEqual(list(get_user_headers.iter_jsonl_headers(
+            lines, 'in.jsonl', errors.append)),
+            [{'User-Agent': 'a'}, {'User-Agent': 'b'}])
+        self.assertEqual([str(x).split(': ')[0] for x in errors],
+                         ['in.jsonl:2', 'in.jsonl:4', 'in.jsonl:5'])
+
+        har = StringIO(json.dumps({'log': {'entries': [
+            {'request': {'headers': [{'name': 'X'}]}}]}}))
+        with self.assertRaises(get_user_headers.RecordError) as ctx:
+            list(get_user_headers.iter_har_headers(har, 'in.har'))
+        self.assertTrue(str(ctx.exception).startswith('in.har:entry 1: '))
+
+    def test_cmd_filter_errors(self):
+        """main: 'filter' reports bad records and can skip them"""
+        in_path = os.path.join(self.tempdir, 'input.jsonl')
+        with io.open(in_path, 'w', encoding='utf-8') as fobj:
+            fobj.write('{"User-Agent": "caf\u00e9"}\nnot json\n{}\n')
+
+        for jobs in ('1', '2'):
+            with patch('get_user_headers.sys.stdout', StringIO()) as stdout:
+                with self.assertRaises(SystemExit) as ctx:
+                    get_user_headers.main(['filter', '-j', jobs, in_path])
+            self.assertIn(in_path + ':2:', str(ctx.exception.code))
+            self.assertEqual(len(stdout.getvalue().splitlines()), 1,
+                             "Records before the bad one should be kept")
+
+        with patch('get_user_headers.sys.stdout', StringIO()) as stdout:
+            with patch('get_user_headers.sys.stderr', StringIO()) as stderr:
+                get_user_headers.main(['filter', '--skip-errors', in_path])
+        self.assertIn(in_path + ':2:', stderr.getvalue())
+        self.assertEqual([json.loads(x) for x in
+                          stdout.getvalue().splitlines()],
+                         [{'User-Agent': 'caf\u00e9'}, {}])
+
+    def test_cmd_filter(self):
+        """main: 'filter' subcommand emits one filtered object per line"""
+        in_path = os.path.join(self.tempdir, 'input.jsonl')
+        with open(in_path, 'w') as fobj:
+            fobj.write(json.dumps(self.test_headers) + '\n')
+            fobj.write(json.dumps(self.test_data) + '\n')
+
+        cache_dir = os.path.join(self.tempdir, 'unused_cache')
+        with patch('get_user_headers.sys.stdout', StringIO()) as stdout:
+            get_user_headers.main(['--cache-dir', cache_dir, 'filter',
+                                   '--safe', in_path])
+        self.assertFalse(os.path.exists(cache_dir), "Shouldn't touch cache")
+
+        results = [json.loads(x) for x in stdout.getvalue().splitlines()]
+        self.assertEqual(len(results), 2)
+        self.check_get_safe(results[0])
+        self.assertEqual(results[1], {})
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), "Requires Unix sockets")
+class HeaderDaemonTests(UserHeaderGetterBase):
+    """Tests for HeaderDaemon and HeaderClient"""
+
+    def setUp(self):
+        """Start a daemon on a background thread"""
+        super(HeaderDaemonTests, self).setUp()
+        self.getter._save_cache(self.test_headers.copy())
+        self.socket_path = os.path.join(self.tempdir, 'daemon.sock')
+        self.client = get_user_headers.HeaderClient(self.socket_path)
+
+        ready = threading.Event()
+        self.daemon = None
+
+        def serve():
+            """Create the daemon (and its getter) on the serving thread"""
+            self.daemon = get_user_headers.HeaderDaemon(self.socket_path,
+                get_user_headers.UserHeaderGetter(self.tempdir))
+            ready.set()
+            self.daemon.serve_forever(poll_interval=0.05)
+            self.daemon.getter.cache_conn.close()
+
+        self.thread = threading.Thread(target=serve)
+        self.thread.start()
+        ready.wait()
+
+    def tearDown(self):
+        """Stop the daemon"""
+        self.daemon.shutdown()
+        self.thread.join()
+        self.daemon.server_close()
+        assert not os.path.exists(self.socket_path)
+        super(HeaderDaemonTests, self).tearDown()
+
+    @patch('get_user_headers.UserHeaderGetter._get_uncached', autospec=True)
+    def test_daemon(self, get_uncached):
+        """HeaderClient: get_all()/get_safe() match UserHeaderGetter"""
+        self.assertEqual(self.client.get_all(), self.getter.get_all())
+        self.assertEqual(self.client.get_safe(), self.getter.get_safe())
+        self.check_get_safe(self.client.get_safe())
+
+        headers = self.test_headers.copy()
+        self.check_get_all(self.client.get_all(headers))
+        self.check_get_safe(self.client.get_safe(headers))
+        assert not get_uncached.called
+
+    def test_daemon_errors(self):
+        """HeaderClient: daemon-side errors are reported, not fatal"""
+        self.assertRaises(get_user_headers.HeaderDaemonError,
+                          self.client._request, 'bogus', None, False)
+        self.check_get_safe(self.client.get_safe())
+
+        self.assertRaises(OSError, get_user_headers.HeaderDaemon,
+                          self.socket_path, self.getter)
+
+    @patch.object(get_user_headers.HeaderDaemonRequestHandler, 'timeout',
+                  0.2)
+    def test_daemon_stalled_client(self):
+        """HeaderDaemon: stalled or oversized requests don't block others"""
+        stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stalled.connect(self.socket_path)
+        try:
+            start = timeit.default_timer()
+            self.check_get_safe(self.client.get_safe())
+            self.assertLess(timeit.default_timer() - start, 2)
+        finally:
+            stalled.close()
+
+        self.assertRaises(get_user_headers.HeaderDaemonError,
+            self.client.get_all, {'X-Padding': 'x' * 70000})
+        self.check_get_safe(self.client.get_safe())
+
+    def test_daemon_getter_untouched(self):
+        """HeaderDaemon: a getter passed in keeps its own harvest_timeout"""
+        self.assertIsNone(self.daemon.getter.harvest_timeout)
+
+    def test_daemon_socket_safety(self):
+        """HeaderDaemon: private socket that never replaces non-sockets"""
+        self.assertEqual(os.stat(self.socket_path).st_mode & 0o777, 0o600)
+
+        not_socket = os.path.join(self.tempdir, 'not_socket')
+        with open(not_socket, 'w') as fobj:
+            fobj.write('precious')
+        self.assertRaises(OSError, get_user_headers.HeaderDaemon,
+                          not_socket, self.getter)
+        with open(not_socket) as fobj:
+            self.assertEqual(fobj.read(), 'precious')
+
+class ResponseCacheTests(UserHeaderGetterBase):
+    """Tests for ResponseCache"""
+
+    def setUp(self):
+        """Start a local origin server and a cache pointed at it"""
+        super(ResponseCacheTests, self).setUp()
+        self.getter._save_cache(self.test_headers.copy())
+        self.cache = get_user_headers.ResponseCache(self.tempdir, self.getter)
+
+        self.httpd = get_user_headers.http_server.HTTPServer(
+            ('127.0.0.1', 0), MockOriginHandler)
+        self.httpd.seen = []
+        self.base_url = 'http://127.0.0.1:{}'.format(self.httpd.server_port)
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       kwargs={'poll_interval': 0.05})
+        self.thread.start()
+
+    def tearDown(self):
+        """Stop the origin server"""
+        self.httpd.shutdown()
+        self.thread.join()
+        self.httpd.server_close()
+        self.cache.cache_conn.close()
+        super(ResponseCacheTests, self).tearDown()
+
+    def fetch_twice(self, path, from_cache):
+        """Fetch ``path`` twice and return the validators sent each time"""
+        first = self.cache.fetch(self.base_url + path)
+        second = self.cache.fetch(self.base_url + path)
+        self.assertFalse(first.from_cache)
+        self.assertEqual(second.from_cache, from_cache)
+        self.assertEqual(first.body, MockOriginHandler.body)
+        self.assertEqual(second.body, MockOriginHandler.body)
+        self.assertEqual(second.status, 200)
+        return [(x[1].get('If-None-Match'), x[1].get('If-Modified-Since'))
+                for x in self.httpd.seen]
+
+    def test_fresh(self):
+        """ResponseCache: fresh responses don't touch the network"""
+        self.assertEqual(self.fetch_twice('/fresh', True), [(None, None)])
+        self.assertEqual(self.httpd.seen[0][1].get('User-Agent'),
+                         self.test_headers['User-Agent'])
+
+        stats = self.cache.stats()
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['requests_saved'], 1)
+        self.assertEqual(stats['bytes_saved'], len(MockOriginHandler.body))
+
+    def test_revalidate(self):
+        """ResponseCache: 304 responses to conditional requests are hits"""
+        self.assertEqual(self.fetch_twice('/etag', True),
+                         [(None, None), ('"v1"', None)])
+        del self.httpd.seen[:]
+        self.assertEqual(self.fetch_twice('/lastmod', True), [(None, None),
+            (None, MockOriginHandler.last_modified)])
+        del self.httpd.seen[:]
+        self.assertEqual(self.fetch_twice('/expired', False),
+                         [(None, None)] * 2)
+
+        stats = self.cache.stats()
+        self.assertEqual(stats['requests_saved'], 0)
+        self.assertEqual(stats['revalidated'], 2)
+        self.assertEqual(stats['bytes_saved'],
+                         len(MockOriginHandler.body) * 2)
+
+    def test_revalidate_headers(self):
+        """ResponseCache: 304 headers merge case-insensitively, not framing
+        """
+        self.fetch_twice('/etag', True)
+        headers = self.cache._lookup(self.base_url + '/etag', {})[1]
+        self.assertEqual(
+            sorted(x for x in headers if x.lower() == 'content-length'),
+            ['Content-Length'])
+        self.assertEqual(
+            [y for x, y in headers.items() if x.lower() == 'content-length'],
+            [str(len(MockOriginHandler.body))])
+        self.assertEqual(
+            [y for x, y in headers.items() if x.lower() == 'x-version'],
+            ['v2'])
+
+    def test_vary(self):
+        """ResponseCache: entries are only used if Vary headers match"""
+        url = self.base_url + '/vary'
+        english, french = {'Accept-Language': 'en'}, {'accept-language': 'fr'}
+        self.assertFalse(self.cache.fetch(url, english).from_cache)
+        self.assertTrue(self.cache.fetch(url, english).from_cache)
+
+        self.assertFalse(self.cache.fetch(url, french).from_cache)
+        self.assertIsNone(self.httpd.seen[-1][1].get('If-None-Match'),
+                          "Shouldn't revalidate another variant")
+        self.assertTrue(self.cache.fetch(url, french).from_cache)
+        self.assertNotIn('If-None-Match',
+                         self.cache.conditional_headers(url, english))
+
+        self.assertIsNone(self.cache._selecting_headers({'Vary': '*'}, {}))
+        self.assertEqual(self.cache._selecting_headers(
+            {'vary': 'Accept, Accept-Language'}, {'Accept': 'text/html'}),
+            {'accept': 'text/html', 'accept-language': None})
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "Requires os.fork()")
+    def test_fork_reconnect(self):
+        """ResponseCache: reopens its SQLite connection after a fork"""
+        self.cache.fetch(self.base_url + '/fresh')
+        parent_conn = self.cache.cache_conn
+
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if not pid:  # pragma: no cover
+            try:
+                success = (self.cache.cache_conn is not parent_conn and
+                    self.cache.fetch(self.base_url + '/fresh').from_cache)
+                os.write(write_fd, b'1' if success else b'0')
+            finally:
+                os._exit(0)  # pylint: disable=protected-access
+
+        os.close(write_fd)
+        try:
+            self.assertEqual(os.read(read_fd, 1), b'1')
+        finally:
+            os.close(read_fd)
+            os.waitpid(pid, 0)
+        self.assertIs(self.cache.cache_conn, parent_conn)
+        self.assertEqual(self.cache.stats()['requests'], 2)
+
+    def test_no_store(self):
+        """ResponseCache: Cache-Control: no-store is honoured"""
+        self.assertEqual(self.fetch_twice('/nostore', False),
+                         [(None, None)] * 2)
+        self.assertIsNone(self.cache._lookup(self.base_url + '/nostore', {}))
+
+    def test_freshness_lifetime(self):
+        """_freshness_lifetime: max-age beats Expires and Age is deducted"""
+        lifetime = get_user_headers._freshness_lifetime
+        self.assertEqual(lifetime({'cache-control': 'public, max-age=60',
+                                   'Expires': 'Thu, 01 Jan 1970 00:00:00 GMT',
+                                   'Age': '10'}), 50)
+        self.assertEqual(lifetime({'Date': 'Sat, 16 Jul 2016 12:00:00 GMT',
+            'Expires': 'Sat, 16 Jul 2016 12:01:00 GMT'}), 60)
+        self.assertEqual(lifetime({'Cache-Control': 'max-age=60, no-cache'}),
+                         0)
+        self.assertEqual(lifetime({'Expires': 'garbage'}), 0)
+        self.assertIsNone(lifetime({'Cache-Control': 'No-Store'}))
+
+if __name__ == '__main__':  # pragma: no cover
+    parser = argparse.ArgumentParser(
+        description="Soak-test concurrent use of one UserHeaderGetter cache")
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=30,
+                        help="Seconds to run for (default: %(default)s)")
+    args = parser.parse_args()
+
+    soak_dir = tempfile.mkdtemp(prefix='soak-')
+    try:
+        report = run_soak(soak_dir, args.threads, args.processes,
+                          args.duration)
+    finally:
+        shutil.rmtree(soak_dir)
+    for key in sorted(report):
+        print('{:>12}: {}'.format(key, report[key]))